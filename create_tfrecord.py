@@ -7,10 +7,14 @@ from deepdrive_dataset.deepdrive_versions import DEEPDRIVE_FOLDS, DEEPDRIVE_VERS
 if __name__ == '__main__':
     logging.getLogger(__name__).setLevel(logging.INFO)
     parser = argparse.ArgumentParser()
-    parser.add_argument('--fold_type', type=str,
-                        default='train', choices=DEEPDRIVE_FOLDS)
-    parser.add_argument('--version', type=str,
-                        default='100k', choices=DEEPDRIVE_VERSIONS)
+    parser.add_argument('--fold_type', type=str, nargs='+',
+                        default=['train'], choices=DEEPDRIVE_FOLDS)
+    parser.add_argument('--version', type=str, nargs='+',
+                        default=['100k'], choices=DEEPDRIVE_VERSIONS)
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of processes writing the tfrecord files of all folds and versions '
+             '(default: number of cpus)')
     parser.add_argument(
         '--elements_per_tfrecord', type=int, default=1000,
         help='Number of Pictures per tfrecord file. '
@@ -31,14 +35,38 @@ if __name__ == '__main__':
         '--daytime', type=str, default=None,
         help='Only write files with this specific daytime'
     )
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='Write the compact schema (packed boxes, labels and flags)'
+    )
+    parser.add_argument(
+        '--normalize_boxes', action='store_true',
+        help='Store the boxes normalized by the image width/height (only with --compact)'
+    )
+    parser.add_argument(
+        '--write_masks', action='store_true',
+        help='Store the drivable area and lane annotations (poly2d) as run-length-encoded masks'
+    )
+    parser.add_argument(
+        '--annotation_threads', type=int, default=16,
+        help='Number of threads loading the annotation files of the old data format'
+    )
+    parser.add_argument(
+        '--consolidate_annotations', action='store_true',
+        help='Store the annotations of the old data format in one json file, which is reused by later runs'
+    )
 
     FLAGS = parser.parse_args()
 
     dd = DeepdriveDatasetWriter()
-    dd.write_tfrecord(
-        FLAGS.fold_type, version=FLAGS.version,
+    dd.write_tfrecords(
+        FLAGS.fold_type, FLAGS.version, workers=FLAGS.workers,
         max_elements_per_file=FLAGS.elements_per_tfrecord,
+        write_masks=FLAGS.write_masks,
         small_size=FLAGS.number_images_to_write,
         weather_type=FLAGS.weather, scene_type=FLAGS.scene_type,
-        daytime_type=FLAGS.daytime
+        daytime_type=FLAGS.daytime, compact=FLAGS.compact,
+        normalize_boxes=FLAGS.normalize_boxes,
+        annotation_threads=FLAGS.annotation_threads,
+        consolidate_annotations=FLAGS.consolidate_annotations
     )
@@ -0,0 +1,201 @@
+import logging
+import os
+import re
+from os.path import expanduser
+
+import tensorflow as tf
+
+from deepdrive_dataset_writer import DeepdriveDatasetWriter, DeepdriveDatasetDownload
+from utils import mkdir_p
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+
+class DeepdriveDatasetExport(object):
+    # the size of the record header (uint64 length, uint32 crc) and footer (uint32 crc) in the TFRecord format
+    record_header_size = 12
+    record_footer_size = 4
+
+    def __init__(self):
+        if pa is None:
+            raise BaseException('The export requires pyarrow. Please install it: pip install pyarrow')
+        self.input_path = os.path.join(expanduser('~'), '.deepdrive')
+        self.writer = DeepdriveDatasetWriter()
+
+    @staticmethod
+    def get_schema():
+        """
+        Returns the arrow schema of the exported dataset. One row per image, the boxes are stored as nested list.
+        The image itself is referenced by the tfrecord file (shard), the byte offset of its record in the file and
+        the length of the serialized example.
+        :return:
+        """
+        box_type = pa.struct([
+            ('id', pa.int64()),
+            ('category', pa.string()),
+            ('label', pa.int32()),
+            ('xmin', pa.float32()),
+            ('ymin', pa.float32()),
+            ('xmax', pa.float32()),
+            ('ymax', pa.float32()),
+            ('truncated', pa.bool_()),
+            ('occluded', pa.bool_()),
+        ])
+        return pa.schema([
+            ('image_id', pa.string()),
+            ('shard', pa.string()),
+            ('offset', pa.int64()),
+            ('length', pa.int64()),
+            ('width', pa.int32()),
+            ('height', pa.int32()),
+            ('weather', pa.string()),
+            ('scene', pa.string()),
+            ('timeofday', pa.string()),
+            ('boxes', pa.list_(box_type)),
+        ])
+
+    @staticmethod
+    def get_record_references(filename):
+        """
+        Returns the image-id, width, height, byte offset and length of every record of the tfrecord file
+        :param filename:
+        :return: list of (image_id, width, height, offset, length)
+        """
+        references, offset = [], 0
+        for record in tf.python_io.tf_record_iterator(filename):
+            feature = tf.train.Example.FromString(record).features.feature
+            references.append((
+                tf.compat.as_str(feature['image/id'].bytes_list.value[0]),
+                feature['image/width'].int64_list.value[0],
+                feature['image/height'].int64_list.value[0],
+                offset, len(record)))
+            offset += DeepdriveDatasetExport.record_header_size + len(record) + \
+                DeepdriveDatasetExport.record_footer_size
+        return references
+
+    def _get_boxes(self, annotations, new_format):
+        if not new_format:
+            boxid, xmin, xmax, ymin, ymax, label_id, label, truncated, occluded = \
+                self.writer._get_boundingboxes(annotations)
+        else:
+            boxid, xmin, xmax, ymin, ymax, label_id, label, truncated, occluded = \
+                self.writer._get_boundingboxes_new_format(annotations)
+        return [
+            dict(id=b, category=c, label=l, xmin=x0, ymin=y0, xmax=x1, ymax=y1, truncated=bool(t), occluded=bool(o))
+            for b, c, l, x0, y0, x1, y1, t, o in
+            zip(boxid, label, label_id, xmin, ymin, xmax, ymax, truncated, occluded)
+        ]
+
+    def get_output_path(self, fold_type, version, output_format='arrow'):
+        version = '100k' if version is None else version
+        output_folder = os.path.join(self.input_path, 'columnar', version)
+        if not os.path.exists(output_folder):
+            mkdir_p(output_folder)
+        return os.path.join(output_folder, '{0}.{1}'.format(fold_type, output_format))
+
+    def get_tfrecord_files(self, fold_type, version=None, small_size=None, weather_type=None, scene_type=None,
+                           daytime_type=None, compact=False):
+        """
+        Returns the tfrecord files of one writer run. The folder of a fold can contain the files of several runs
+        (e.g. filtered or compact ones), they are told apart by the filename template of the writer.
+        :param fold_type:
+        :param version:
+        :param small_size: see DeepdriveDatasetWriter.write_tfrecord
+        :param weather_type: see DeepdriveDatasetWriter.write_tfrecord
+        :param scene_type: see DeepdriveDatasetWriter.write_tfrecord
+        :param daytime_type: see DeepdriveDatasetWriter.write_tfrecord
+        :param compact: see DeepdriveDatasetWriter.write_tfrecord
+        :return: sorted list of filenames
+        """
+        tfrecord_folder = os.path.join(
+            self.input_path, 'tfrecord', '100k' if version is None else version, fold_type)
+        template = os.path.basename(DeepdriveDatasetWriter.get_output_file_name_template(
+            tfrecord_folder, fold_type, version, small_size, weather_type, scene_type, daytime_type, compact))
+        prefix = template[:template.index('{iteration')]
+        filename_regex = re.compile('^' + re.escape(prefix) + '[0-9]{6}\\.tfrecord$')
+        return sorted(DeepdriveDatasetDownload.filter_files(tfrecord_folder, False, filename_regex))
+
+    def export(self, fold_type, version=None, output_format='arrow', output_path=None, annotation_threads=16,
+               small_size=None, weather_type=None, scene_type=None, daytime_type=None, compact=False):
+        """
+        Exports the annotations of the tfrecord files of the fold to a columnar dataset. Only the files written
+        with the given writer parameters are exported (see get_tfrecord_files).
+        :param fold_type: 'train', 'val', 'test'
+        :param version: '100k', '10k'
+        :param output_format: 'arrow' (arrow ipc file, which can be memory-mapped) or 'parquet'
+        :param output_path: (default: ~/.deepdrive/columnar/[version]/[fold_type].[output_format])
+        :param annotation_threads: number of threads loading the json files of the old data-format
+        :param small_size: select the files written with this small_size (default: None)
+        :param weather_type: select the files written with this weather filter (default: None)
+        :param scene_type: select the files written with this scene filter (default: None)
+        :param daytime_type: select the files written with this daytime filter (default: None)
+        :param compact: select the files written with the compact schema (default: False)
+        :return: the output path
+        """
+        assert (output_format in ['arrow', 'parquet'])
+        logger = logging.getLogger(__name__)
+        filenames = self.get_tfrecord_files(
+            fold_type, version, small_size, weather_type, scene_type, daytime_type, compact)
+        if not filenames:
+            raise BaseException('No TFRecord files found for fold: {0} version: {1}'.format(fold_type, version))
+
+        references = []
+        for filename in filenames:
+            logger.info('Reading record references from: {0}'.format(filename))
+            references.extend(
+                (os.path.basename(filename),) + r for r in DeepdriveDatasetExport.get_record_references(filename))
+
+        image_ids = [r[1] for r in references]
+        if len(set(image_ids)) != len(image_ids):
+            logger.warning('{0} image ids appear more than once in: {1}'.format(
+                len(image_ids) - len(set(image_ids)), filenames))
+
+        _, full_labels_path, new_format = self.writer.get_image_label_folder(fold_type, version)
+        obj_annotation_dict = self.writer.get_annotations_dict(
+            fold_type, version, full_labels_path, new_format, image_ids, annotation_threads)
+
+        columns = dict((name, []) for name in self.get_schema().names)
+        for shard, image_id, width, height, offset, length in references:
+            annotations = obj_annotation_dict.get(image_id, None)
+            attributes = (annotations or dict()).get('attributes', None) or dict()
+            columns['image_id'].append(image_id)
+            columns['shard'].append(shard)
+            columns['offset'].append(offset)
+            columns['length'].append(length)
+            columns['width'].append(width)
+            columns['height'].append(height)
+            columns['weather'].append(attributes.get('weather', None))
+            columns['scene'].append(attributes.get('scene', None))
+            columns['timeofday'].append(attributes.get('timeofday', None))
+            columns['boxes'].append(self._get_boxes(annotations, new_format))
+
+        schema = self.get_schema()
+        table = pa.Table.from_arrays(
+            [pa.array(columns[field.name], type=field.type) for field in schema], schema=schema)
+
+        output_path = self.get_output_path(fold_type, version, output_format) if output_path is None else output_path
+        logger.info('Writing {0} rows to: {1}'.format(table.num_rows, output_path))
+        if output_format == 'parquet':
+            pq.write_table(table, output_path)
+        else:
+            with pa.OSFile(output_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(table)
+        return output_path
+
+    @staticmethod
+    def load(path, columns=None):
+        """
+        Loads an exported dataset. Arrow files are memory-mapped, so only the pages of the used columns are read.
+        :param path:
+        :param columns: list of column names to load (default: all)
+        :return: pyarrow.Table
+        """
+        if path.endswith('.parquet'):
+            return pq.read_table(path, columns=columns, memory_map=True)
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        return table if columns is None else table.select(columns)
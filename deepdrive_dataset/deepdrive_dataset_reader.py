@@ -4,6 +4,7 @@ import re
 from os.path import expanduser
 
 from deepdrive_dataset_writer import DeepdriveDatasetWriter, DeepdriveDatasetDownload
+from deepdrive_versions import DEEPDRIVE_SCHEMA_LEGACY, DEEPDRIVE_SCHEMA_COMPACT
 from scope_wrapper import scope_wrapper
 from tf_features import *
 from utils import mkdir_p
@@ -19,6 +20,68 @@ def _recover_boundingboxes(features):
     return tf.transpose([ymin, xmin, ymax, xmax])
 
 
+@scope_wrapper
+def _recover_flags(features, key):
+    """ Decodes the bool array which has been stored with numpy.tobytes() in the legacy schema. """
+    raw = tf.reduce_join(features[key].values)
+    return tf.cast(tf.decode_raw(raw, tf.uint8), tf.bool)
+
+
+@scope_wrapper
+def _recover_packed_boundingboxes(features):
+    """
+    Creates a list of boxes [(ymin,xmin, ...), ...] in pixels from the packed float32 buffer of the compact schema.
+    Normalized boxes are scaled back by the image height / width.
+    """
+    boxes = tf.reshape(tf.decode_raw(features['image/object/bbox/packed'], tf.float32), [-1, 4])
+    height = tf.cast(features['image/height'], tf.float32)
+    width = tf.cast(features['image/width'], tf.float32)
+    scale = tf.cond(tf.equal(features['image/object/bbox/normalized'], 1),
+                    lambda: tf.stack([height, width, height, width]), lambda: tf.ones([4], tf.float32))
+    return boxes * scale
+
+
+@scope_wrapper
+def _recover_packed_flags(features, key):
+    """ Unpacks the flags which have been stored with numpy.packbits() (most significant bit first). """
+    packed = tf.cast(tf.decode_raw(features[key], tf.uint8), tf.int32)
+    bit_values = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.int32)
+    bits = tf.mod(tf.floordiv(tf.expand_dims(packed, 1), bit_values), 2)
+    return tf.cast(tf.reshape(bits, [-1])[:features['image/object/count']], tf.bool)
+
+
+@scope_wrapper
+def _decode_rle_mask(rle, height, width):
+    """ Decodes one mask, which has been stored with masks.rle_encode(), to a dense bool tensor [height, width]. """
+    counts = tf.decode_raw(rle, tf.int32)
+    ends = tf.cumsum(counts)
+    starts = ends - counts
+    # every second run (starting with the second) is foreground
+    fg_starts, fg_ends = starts[1::2], ends[1::2]
+    deltas = tf.unsorted_segment_sum(
+        tf.concat([tf.ones_like(fg_starts), -tf.ones_like(fg_ends)], axis=0),
+        tf.concat([fg_starts, fg_ends], axis=0), tf.cast(height * width + 1, tf.int32))
+    return tf.reshape(tf.cumsum(deltas)[:-1] > 0, tf.stack([height, width]))
+
+
+@scope_wrapper
+def decode_rle_masks(rle_masks, height, width):
+    """
+    Decodes a vector of run-length-encoded masks to a dense bool tensor [num_masks, height, width]
+    :param rle_masks: string tensor [num_masks]
+    :param height: int tensor
+    :param width: int tensor
+    :return:
+    """
+    height, width = tf.cast(height, tf.int32), tf.cast(width, tf.int32)
+    # map_fn can not stack zero elements of an unknown shape, images without masks are handled separately
+    return tf.cond(
+        tf.size(rle_masks) > 0,
+        lambda: tf.map_fn(lambda rle: _decode_rle_mask(rle, height, width), rle_masks, dtype=tf.bool,
+                          back_prop=False),
+        lambda: tf.zeros(tf.stack([0, height, width]), tf.bool))
+
+
 class DeepdriveDatasetReader():
 
     def get_folders(self):
@@ -58,7 +121,7 @@ class DeepdriveDatasetReader():
         :param filenames:
         :param parsing_fn:
         :param shape_fn: array of shapes, which are returned from the parsing_fn
-        :param parallel_reads: int - Parallel calls to the parsing function (default=2)
+        :param parallel_reads: int - Number of tfrecord files read in parallel (default=2)
         :param num_chained_buffers: int - Number of chained shuffle operations
         :param buffer_size: int - Buffer size used for the shuffling of elements (default=128)
         :param repeat: int - Number of times the dataset contents are repeated (default=1)
@@ -69,7 +132,7 @@ class DeepdriveDatasetReader():
         assert(filenames != [] and
                parsing_fn is not None and shape_fn is not None)
         random.shuffle(filenames)
-        dataset = tf.data.TFRecordDataset(filenames)
+        dataset = tf.data.TFRecordDataset(filenames, num_parallel_reads=parallel_reads)
         # TODO: do the interleaving: http://www.moderndescartes.com/essays/shuffle_viz/
         dataset = dataset.repeat(repeat)
         dataset = dataset.map(parsing_fn, num_parallel_calls=num_threads)
@@ -80,37 +143,121 @@ class DeepdriveDatasetReader():
         return dataset
 
     @staticmethod
-    def parsing_boundingboxes(serialized_example, output='tensors'):
+    def _recover_boxes_schema(features, schema_version, return_flags=False):
+        """
+        Recovers the boxes of parsed features written with the given schema. Boxes are always returned in pixels.
+        :param features: the parsed features
+        :param schema_version: DEEPDRIVE_SCHEMA_LEGACY or DEEPDRIVE_SCHEMA_COMPACT
+        :param return_flags: additionally recover the truncated / occluded flags
+        :return: boundingboxes, boundingbox_labels, box_ids (, truncated, occluded)
+        """
+        if schema_version == DEEPDRIVE_SCHEMA_COMPACT:
+            outputs = (
+                _recover_packed_boundingboxes(features),
+                tf.cast(tf.decode_raw(features['image/object/class/label/packed'], tf.uint8), tf.int64),
+                tf.decode_raw(features['image/object/bbox/id/packed'], tf.int64),
+            )
+            if return_flags:
+                outputs += (
+                    _recover_packed_flags(features, 'image/object/bbox/truncated/packed'),
+                    _recover_packed_flags(features, 'image/object/bbox/occluded/packed'),
+                )
+            return outputs
+        outputs = (
+            _recover_boundingboxes(features),
+            tf.cast(features['image/object/class/label'].values, tf.int64),
+            tf.cast(features['image/object/bbox/id'].values, tf.int64),
+        )
+        if return_flags:
+            outputs += (
+                _recover_flags(features, 'image/object/bbox/truncated'),
+                _recover_flags(features, 'image/object/bbox/occluded'),
+            )
+        return outputs
+
+    @staticmethod
+    def parsing_boundingboxes(serialized_example, output='tensors', schema_version=None, return_flags=False):
         """
 
         :param serialized_example:
         :param output: (anything, 'shape', 'labels')
+        :param schema_version: DEEPDRIVE_SCHEMA_LEGACY or DEEPDRIVE_SCHEMA_COMPACT. If None the features of both
+        schemas are parsed at once and image/schema_version of each record selects which of them are used, so that
+        files of both schemas can be mixed (default: None)
+        :param return_flags: additionally return the truncated / occluded flags of the boxes (default: False)
         :return:
         """
         if output == 'shape':
-            return ([None, None, 3], [None, 4], [None], [], [None], [2], )
+            shapes = ([None, None, 3], [None, 4], [None], [], [None], [2], )
+            return shapes + ([None], [None], ) if return_flags else shapes
         if output == 'labels':
-            return 'image', 'bboxes', 'bbox_labels', 'image_ids', 'box_ids', 'image_shape'
+            labels = ('image', 'bboxes', 'bbox_labels', 'image_ids', 'box_ids', 'image_shape')
+            return labels + ('bbox_truncated', 'bbox_occluded') if return_flags else labels
 
-        feature_def = DeepdriveDatasetWriter.feature_dict_description('reading_shape')
+        if schema_version is None:
+            feature_def = dict(DeepdriveDatasetWriter.feature_dict_description(
+                'reading_shape', DEEPDRIVE_SCHEMA_LEGACY))
+            feature_def.update(DeepdriveDatasetWriter.feature_dict_description(
+                'reading_shape', DEEPDRIVE_SCHEMA_COMPACT))
+            # records without marker have been written with the legacy schema
+            feature_def['image/schema_version'] = tf.FixedLenFeature((), tf.int64, DEEPDRIVE_SCHEMA_LEGACY)
+        else:
+            feature_def = DeepdriveDatasetWriter.feature_dict_description('reading_shape', schema_version)
         features = tf.parse_single_example(serialized_example, feature_def)
 
         image = tf.image.decode_jpeg(features['image/encoded'], channels=3)
-        boundingboxes = _recover_boundingboxes(features)
+        image_shape = tf.convert_to_tensor([features['image/width'], features['image/height']])
+        image_ids = features['image/id']
+        if schema_version is None:
+            boxes = tf.cond(
+                tf.equal(features['image/schema_version'], DEEPDRIVE_SCHEMA_COMPACT),
+                lambda: DeepdriveDatasetReader._recover_boxes_schema(
+                    features, DEEPDRIVE_SCHEMA_COMPACT, return_flags),
+                lambda: DeepdriveDatasetReader._recover_boxes_schema(
+                    features, DEEPDRIVE_SCHEMA_LEGACY, return_flags))
+        else:
+            boxes = DeepdriveDatasetReader._recover_boxes_schema(features, schema_version, return_flags)
+        boundingboxes, boundingbox_labels, box_ids = boxes[:3]
+        outputs = (image, boundingboxes, boundingbox_labels, image_ids, box_ids, image_shape) + tuple(boxes[3:])
+        return tuple(tf.stop_gradient(o) for o in outputs)
 
+    @staticmethod
+    def parsing_masks(serialized_example, output='tensors', decode_masks=False):
+        """
+        Parses the masks written with write_masks=True. By default the masks are returned run-length-encoded, they
+        are only decoded to dense masks [num_masks, height, width] if decode_masks is set. The run-length-encoded
+        masks can be decoded later on with decode_rle_masks.
+        :param serialized_example:
+        :param output: (anything, 'shape', 'labels')
+        :param decode_masks: return dense bool masks instead of the run-length-encoded strings
+        :return:
+        """
+        if output == 'shape':
+            mask_shape = [None, None, None] if decode_masks else [None]
+            return ([None, None, 3], mask_shape, [None], [], [None], [2], )
+        if output == 'labels':
+            return 'image', 'masks', 'mask_labels', 'image_ids', 'mask_ids', 'image_shape'
+
+        feature_def = DeepdriveDatasetWriter.feature_dict_description('reading_masks')
+        features = tf.parse_single_example(serialized_example, feature_def)
+
+        image = tf.image.decode_jpeg(features['image/encoded'], channels=3)
         image_shape = tf.convert_to_tensor([features['image/width'], features['image/height']])
         image_ids = features['image/id']
-        box_ids = tf.cast(features['image/object/bbox/id'].values, tf.int64)
-        boundingbox_labels = tf.cast(features['image/object/class/label'].values, tf.int64)
-        return tf.stop_gradient(image), tf.stop_gradient(boundingboxes), \
-               tf.stop_gradient(boundingbox_labels), tf.stop_gradient(image_ids), \
-               tf.stop_gradient(box_ids), tf.stop_gradient(image_shape)
+        masks = features['image/object/mask/rle'].values
+        if decode_masks:
+            masks = decode_rle_masks(masks, features['image/height'], features['image/width'])
+        mask_ids = tf.cast(features['image/object/mask/id'].values, tf.int64)
+        mask_labels = tf.cast(features['image/object/mask/class/label'].values, tf.int64)
+        return tf.stop_gradient(image), tf.stop_gradient(masks), \
+               tf.stop_gradient(mask_labels), tf.stop_gradient(image_ids), \
+               tf.stop_gradient(mask_ids), tf.stop_gradient(image_shape)
 
     def get_version_folder(self, fold_type, version):
         version = '100k' if version is None else version
         return os.path.join(self.input_path, version, fold_type)
 
-    def load_boundingbox_data(self, fold_type, version, download=False):
+    def load_boundingbox_data(self, fold_type, version, download=False, schema_version=None, return_flags=False):
         train_dir = self.get_version_folder(fold_type, version)
         filenames = DeepdriveDatasetDownload.filter_files(train_dir, False, re.compile('\.tfrecord$'))
         if len(filenames) == 0 and download:
@@ -118,16 +265,30 @@ class DeepdriveDatasetReader():
                   'Build tfrecords.'.format(train_dir))
             exit(-1)
 
-        parser = lambda x: DeepdriveDatasetReader.parsing_boundingboxes(x)
-        shape = DeepdriveDatasetReader.parsing_boundingboxes(None, 'shape')
+        parser = lambda x: DeepdriveDatasetReader.parsing_boundingboxes(
+            x, schema_version=schema_version, return_flags=return_flags)
+        shape = DeepdriveDatasetReader.parsing_boundingboxes(None, 'shape', return_flags=return_flags)
+        dataset = self.generate_dataset(
+            filenames, parser, shape,
+            self.parallel_reads, self.num_chained_buffers,
+            self.buffer_size, self.epochs, self.threads, self.batch_size)
+        return dataset.make_one_shot_iterator().get_next(name='sample_tensor')
+
+    def load_mask_data(self, fold_type, version, decode_masks=False):
+        train_dir = self.get_version_folder(fold_type, version)
+        filenames = DeepdriveDatasetDownload.filter_files(train_dir, False, re.compile('\.tfrecord$'))
+
+        parser = lambda x: DeepdriveDatasetReader.parsing_masks(x, decode_masks=decode_masks)
+        shape = DeepdriveDatasetReader.parsing_masks(None, 'shape', decode_masks)
         dataset = self.generate_dataset(
             filenames, parser, shape,
             self.parallel_reads, self.num_chained_buffers,
-            self.buffer_size, self.epochs, self.epochs, self.batch_size)
+            self.buffer_size, self.epochs, self.threads, self.batch_size)
         return dataset.make_one_shot_iterator().get_next(name='sample_tensor')
 
-    def load_data_bbox(self, fold_type=None, version=None, download=False, write_masks=False):
-        return self.load_boundingbox_data(fold_type, version, download)
+    def load_data_bbox(self, fold_type=None, version=None, download=False, write_masks=False,
+                       schema_version=None, return_flags=False):
+        return self.load_boundingbox_data(fold_type, version, download, schema_version, return_flags)
 
     def load_train_data_bbox(self, version=None, download=True):
         return self.load_data_bbox('train', version, download)
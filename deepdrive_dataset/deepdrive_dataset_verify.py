@@ -0,0 +1,221 @@
+import io
+import mmap
+import os
+import re
+import struct
+from os.path import expanduser
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from deepdrive_dataset_download import DeepdriveDatasetDownload
+from deepdrive_versions import DEEPDRIVE_SCHEMA_COMPACT
+from utils import map_largest_first
+
+try:
+    # optional C implementations, the pure python fallback is an order of magnitude slower
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    try:
+        from google_crc32c import value as _crc32c
+    except ImportError:
+        _crc32c = None
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _crc32c_python(data):
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for b in bytearray(data):
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """ Returns the masked crc32c checksum, which is used in the TFRecord format. """
+    crc = _crc32c(data) if _crc32c is not None else _crc32c_python(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+class DeepdriveDatasetVerify(object):
+    # TFRecord layout: uint64 length, uint32 masked_crc32c(length), data, uint32 masked_crc32c(data)
+    header_struct = struct.Struct('<QI')
+    footer_struct = struct.Struct('<I')
+
+    def __init__(self, processes=None, sample_rate=0.0, check_boxes=True):
+        """
+        :param processes: number of worker processes (default: number of cpus)
+        :param sample_rate: fraction of the records which are parsed and whose jpeg is decoded (default: 0.0)
+        :param check_boxes: check the boxes of the sampled records against image/width and image/height
+        """
+        assert (0.0 <= sample_rate <= 1.0)
+        self.processes = processes
+        self.sample_rate = sample_rate
+        self.check_boxes = check_boxes
+        self.input_path = os.path.join(expanduser('~'), '.deepdrive', 'tfrecord')
+
+    def get_version_folder(self, fold_type, version):
+        version = '100k' if version is None else version
+        return os.path.join(self.input_path, version, fold_type)
+
+    @staticmethod
+    def _get_boxes(feature, image_width, image_height):
+        """
+        Returns the boxes [(ymin, xmin, ymax, xmax), ...] in pixels for both schemas
+        :param feature: the feature map of a tf.train.Example
+        :return:
+        """
+        if 'image/schema_version' in feature and \
+                feature['image/schema_version'].int64_list.value[0] == DEEPDRIVE_SCHEMA_COMPACT:
+            boxes = np.frombuffer(
+                feature['image/object/bbox/packed'].bytes_list.value[0], dtype='<f4').reshape(-1, 4)
+            if feature['image/object/bbox/normalized'].int64_list.value[0]:
+                boxes = boxes * np.asarray([image_height, image_width, image_height, image_width])
+            return boxes
+        return np.asarray([
+            feature['image/object/bbox/ymin'].float_list.value,
+            feature['image/object/bbox/xmin'].float_list.value,
+            feature['image/object/bbox/ymax'].float_list.value,
+            feature['image/object/bbox/xmax'].float_list.value,
+        ], dtype=np.float32).reshape(4, -1).T
+
+    @staticmethod
+    def _check_record(data, check_boxes=True):
+        """
+        Parses the example, decodes the jpeg and checks the boxes
+        :param data: serialized tf.train.Example
+        :param check_boxes:
+        :return: (decode_error, box_error) - error messages or None
+        """
+        try:
+            feature = tf.train.Example.FromString(data).features.feature
+            image_width = feature['image/width'].int64_list.value[0]
+            image_height = feature['image/height'].int64_list.value[0]
+            im = Image.open(io.BytesIO(feature['image/encoded'].bytes_list.value[0]))
+            im.load()
+            if im.size != (image_width, image_height):
+                return 'image size {0} does not match width/height {1}'.format(
+                    im.size, (image_width, image_height)), None
+        except Exception as e:
+            return str(e), None
+        if not check_boxes:
+            return None, None
+        boxes = DeepdriveDatasetVerify._get_boxes(feature, image_width, image_height)
+        # small tolerance for the float32 conversion of the coordinates
+        upper = np.asarray([image_height, image_width, image_height, image_width]) + 1e-3
+        invalid = np.any((boxes < -1e-3) | (boxes > upper), axis=1) | \
+                  (boxes[:, 2] < boxes[:, 0]) | (boxes[:, 3] < boxes[:, 1])
+        if np.any(invalid):
+            return None, '{0} of {1} boxes outside of the image'.format(int(invalid.sum()), boxes.shape[0])
+        return None, None
+
+    @staticmethod
+    def verify_file(filename, sample_rate=0.0, check_boxes=True):
+        """
+        Verifies one tfrecord file: validates the length and data checksums of every record, counts the records
+        and parses a sample of them.
+        :param filename:
+        :param sample_rate: fraction of the records which are parsed and whose jpeg is decoded
+        :param check_boxes:
+        :return: dict - the report for the file
+        """
+        report = dict(filename=filename, records=0, size=0, crc_errors=[], decode_errors=[], box_errors=[],
+                      truncated=False, sampled=0)
+        sample_stride = int(round(1.0 / sample_rate)) if sample_rate > 0 else 0
+        header_size = DeepdriveDatasetVerify.header_struct.size
+        footer_size = DeepdriveDatasetVerify.footer_struct.size
+        try:
+            report['size'] = os.path.getsize(filename)
+            if report['size'] == 0:
+                return report
+            with open(filename, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            report['decode_errors'].append(dict(record=None, error=str(e)))
+            return report
+
+        try:
+            offset, size = 0, report['size']
+            while offset < size:
+                record_id = report['records']
+                if offset + header_size > size:
+                    report['truncated'] = True
+                    break
+                length, length_crc = DeepdriveDatasetVerify.header_struct.unpack_from(mm, offset)
+                if masked_crc32c(mm[offset:offset + 8]) != length_crc:
+                    # the length can not be trusted, so the rest of the file can not be read
+                    report['crc_errors'].append(dict(record=record_id, offset=offset, part='length'))
+                    break
+                data_start = offset + header_size
+                data_end = data_start + length
+                if data_end + footer_size > size:
+                    report['truncated'] = True
+                    break
+                # slicing the mmap copies the record, which works with the buffer support of python 2 and 3
+                data = mm[data_start:data_end]
+                data_crc, = DeepdriveDatasetVerify.footer_struct.unpack_from(mm, data_end)
+                if masked_crc32c(data) != data_crc:
+                    report['crc_errors'].append(dict(record=record_id, offset=offset, part='data'))
+                elif sample_stride and record_id % sample_stride == 0:
+                    decode_error, box_error = DeepdriveDatasetVerify._check_record(data, check_boxes)
+                    report['sampled'] += 1
+                    if decode_error is not None:
+                        report['decode_errors'].append(dict(record=record_id, offset=offset, error=decode_error))
+                    if box_error is not None:
+                        report['box_errors'].append(dict(record=record_id, offset=offset, error=box_error))
+                report['records'] += 1
+                offset = data_end + footer_size
+        finally:
+            mm.close()
+        return report
+
+    def verify(self, fold_type, version):
+        """
+        Verifies all tfrecord files of the given fold and version in parallel
+        :param fold_type: 'train', 'val', 'test'
+        :param version: '100k', '10k'
+        :return: dict - machine-readable report with one entry per file and the totals
+        """
+        folder = self.get_version_folder(fold_type, version)
+        filenames = sorted(DeepdriveDatasetDownload.filter_files(folder, False, re.compile('\.tfrecord$')))
+        files = map_largest_first(
+            _verify_file, [(f, self.sample_rate, self.check_boxes) for f in filenames],
+            lambda job: os.path.getsize(job[0]), self.processes)
+        files = sorted(files, key=lambda r: r['filename'])
+        errors = []
+        if not files:
+            errors.append('No TFRecord files found in: {0}'.format(folder))
+        elif sum(r['records'] for r in files) == 0:
+            errors.append('The TFRecord files in {0} contain no records'.format(folder))
+        return dict(
+            folder=folder, fold_type=fold_type, version=version,
+            fast_crc=_crc32c is not None,
+            errors=errors,
+            files=files,
+            total_files=len(files),
+            total_records=sum(r['records'] for r in files),
+            total_sampled=sum(r['sampled'] for r in files),
+            total_crc_errors=sum(len(r['crc_errors']) for r in files),
+            total_decode_errors=sum(len(r['decode_errors']) for r in files),
+            total_box_errors=sum(len(r['box_errors']) for r in files),
+            truncated_files=[r['filename'] for r in files if r['truncated']],
+            ok=not errors and all(not (r['crc_errors'] or r['decode_errors'] or r['box_errors'] or r['truncated'])
+                   for r in files),
+        )
+
+
+def _verify_file(*args):
+    return DeepdriveDatasetVerify.verify_file(*args)
@@ -6,12 +6,15 @@ from os.path import expanduser
 
 import zipfile
 import datetime
+from multiprocessing.pool import ThreadPool
 import tensorflow as tf
 import numpy as np
 
-from utils import mkdir_p
+from utils import mkdir_p, map_largest_first
 from deepdrive_dataset_download import DeepdriveDatasetDownload
-from deepdrive_versions import DEEPDRIVE_LABELS
+from deepdrive_versions import DEEPDRIVE_LABELS, DEEPDRIVE_SCHEMA_LEGACY, DEEPDRIVE_SCHEMA_COMPACT, \
+    DEEPDRIVE_MASK_LABELS, DEEPDRIVE_MASK_LABEL_PREFIXES
+from masks import rasterize_polygon, rasterize_polyline, rle_encode
 from tf_features import *
 from PIL import Image
 
@@ -37,15 +40,75 @@ class DeepdriveDatasetWriter(object):
         'image/filename': None,
     }
 
+    compact_feature_dict = {
+        'image/schema_version': None,
+        'image/height': None,
+        'image/width': None,
+        'image/object/count': None,
+        'image/object/bbox/packed': None,
+        'image/object/bbox/normalized': None,
+        'image/object/bbox/id/packed': None,
+        'image/object/bbox/truncated/packed': None,
+        'image/object/bbox/occluded/packed': None,
+        'image/object/class/label/packed': None,
+        'image/encoded': None,
+        'image/format': None,
+        'image/id': None,
+        'image/source_id': None,
+        'image/filename': None,
+    }
+
+    mask_feature_dict = {
+        'image/object/mask/id': None,
+        'image/object/mask/rle': None,
+        'image/object/mask/class/label': None,
+        'image/object/mask/class/label/name': None,
+    }
+
     @staticmethod
-    def feature_dict_description(type='feature_dict'):
+    def feature_dict_description(type='feature_dict', schema_version=DEEPDRIVE_SCHEMA_LEGACY):
         """
         Get the feature dict. In the default case it is filled with all the keys and the items set to None. If the
         type=reading_shape the shape description required for reading elements from a tfrecord is returned)
         :param type: (anything = returns the feature_dict with empty elements, reading_shape = element description for
-        reading the tfrecord files is returned)
+        reading the tfrecord files is returned, reading_masks = element description for reading the image and the
+        masks written with write_masks=True)
+        :param schema_version: DEEPDRIVE_SCHEMA_LEGACY or DEEPDRIVE_SCHEMA_COMPACT
         :return:
         """
+        if type == 'reading_masks':
+            # the masks are stored in the same way for both schemas
+            return {
+                'image/height': tf.FixedLenFeature((), tf.int64, 1),
+                'image/width': tf.FixedLenFeature((), tf.int64, 1),
+                'image/encoded': tf.FixedLenFeature((), tf.string, default_value=''),
+                'image/id': tf.FixedLenFeature((), tf.string, default_value=''),
+                'image/object/mask/id': tf.VarLenFeature(tf.int64),
+                'image/object/mask/rle': tf.VarLenFeature(tf.string),
+                'image/object/mask/class/label': tf.VarLenFeature(tf.int64),
+                'image/object/mask/class/label/name': tf.VarLenFeature(tf.string),
+            }
+
+        if schema_version == DEEPDRIVE_SCHEMA_COMPACT:
+            obj = DeepdriveDatasetWriter.compact_feature_dict
+            if type == 'reading_shape':
+                obj['image/schema_version'] = tf.FixedLenFeature((), tf.int64, DEEPDRIVE_SCHEMA_COMPACT)
+                obj['image/height'] = tf.FixedLenFeature((), tf.int64, 1)
+                obj['image/width'] = tf.FixedLenFeature((), tf.int64, 1)
+                obj['image/object/count'] = tf.FixedLenFeature((), tf.int64, 0)
+                obj['image/object/bbox/packed'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/object/bbox/normalized'] = tf.FixedLenFeature((), tf.int64, 0)
+                obj['image/object/bbox/id/packed'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/object/bbox/truncated/packed'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/object/bbox/occluded/packed'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/object/class/label/packed'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/encoded'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/format'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/filename'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/id'] = tf.FixedLenFeature((), tf.string, default_value='')
+                obj['image/source_id'] = tf.FixedLenFeature((), tf.string, default_value='')
+            return obj
+
         obj = DeepdriveDatasetWriter.feature_dict
         if type == 'reading_shape':
             obj['image/height'] = tf.FixedLenFeature((), tf.int64, 1)
@@ -69,6 +132,23 @@ class DeepdriveDatasetWriter(object):
 
     def __init__(self):
         self.input_path = os.path.join(expanduser('~'), '.deepdrive')
+        # directory listings, folder layouts and annotations are cached, so that converting several folds and
+        # versions with one writer scans and loads them only once
+        self._directory_cache = dict()
+        self._image_label_folder_cache = dict()
+        self._annotation_cache = dict()
+
+    def _filter_files(self, path):
+        """ Cached version of DeepdriveDatasetDownload.filter_files(path, True) """
+        if ('files', path) not in self._directory_cache:
+            self._directory_cache[('files', path)] = DeepdriveDatasetDownload.filter_files(path, True)
+        return self._directory_cache[('files', path)]
+
+    def _filter_folders(self, path):
+        """ Cached version of DeepdriveDatasetDownload.filter_folders(path, True) """
+        if ('folders', path) not in self._directory_cache:
+            self._directory_cache[('folders', path)] = DeepdriveDatasetDownload.filter_folders(path, True)
+        return self._directory_cache[('folders', path)]
 
     def unzip_file_to_folder(self, filename, folder, remove_file_after_creating=True):
         assert (os.path.exists(filename) and os.path.isfile(filename))
@@ -89,6 +169,11 @@ class DeepdriveDatasetWriter(object):
         assert (fold_type in ['train', 'test', 'val'])
         version = '100k' if version is None else version
         assert (version in ['100k', '10k'])
+        if (fold_type, version) not in self._image_label_folder_cache:
+            self._image_label_folder_cache[(fold_type, version)] = self._get_image_label_folder(fold_type, version)
+        return self._image_label_folder_cache[(fold_type, version)]
+
+    def _get_image_label_folder(self, fold_type, version, extract=True):
 
         download_folder = os.path.join(self.input_path, 'download')
         expansion_images_folder = os.path.join(self.input_path, 'images')
@@ -108,11 +193,11 @@ class DeepdriveDatasetWriter(object):
 
         extract_files = True
 
-        valid_folder_structure_old_format = (len(DeepdriveDatasetDownload.filter_folders(full_labels_path)) == 2 and \
-                                             len(DeepdriveDatasetDownload.filter_files(full_images_path)) > 0)
+        valid_folder_structure_old_format = (len(self._filter_folders(full_labels_path)) == 2 and \
+                                             len(self._filter_files(full_images_path)) > 0)
 
-        valid_folder_structure_new_format = (len(DeepdriveDatasetDownload.filter_files(full_labels_path)) == 2 and \
-                                             len(DeepdriveDatasetDownload.filter_files(full_images_path)) > 0)
+        valid_folder_structure_new_format = (len(self._filter_files(full_labels_path)) == 2 and \
+                                             len(self._filter_files(full_images_path)) > 0)
 
         if valid_folder_structure_old_format or valid_folder_structure_new_format:
             print('Do not check the download folder. Pictures seem to exist.')
@@ -120,13 +205,19 @@ class DeepdriveDatasetWriter(object):
                 full_labels_path = os.path.join(full_labels_path, fold_type)
 
             extract_files = False
-        elif os.path.exists(download_folder):
+        else:
+            # the listings of an incomplete layout are not kept, they change once the files are extracted
+            self._directory_cache.clear()
+        if extract_files and not extract:
+            raise BaseException('The extracted files do not have the expected folder layout in: {0}, {1}'.format(
+                full_images_path, full_labels_path))
+        elif extract_files and os.path.exists(download_folder):
             files_in_directory = DeepdriveDatasetDownload.filter_files(download_folder, False, re.compile('\.zip$'))
             if len(files_in_directory) < 2:
                 raise BaseException('Not enough files found in {0}. All files present: {1}'.format(
                     download_folder, files_in_directory
                 ))
-        else:
+        elif extract_files:
             mkdir_p(download_folder)
             raise BaseException('Download folder: {0} did not exist. It had been created. '
                                 'Please put images, labels there.'.format(download_folder))
@@ -146,6 +237,9 @@ class DeepdriveDatasetWriter(object):
             self.unzip_file_to_folder(
                 os.path.join(download_folder, 'bdd100k_images.zip'),
                 expansion_images_folder, False)
+            # check the layout again on fresh listings of the extracted folders
+            self._directory_cache.clear()
+            return self._get_image_label_folder(fold_type, version, extract=False)
 
         if fold_type == 'test':
             return full_images_path, None, True
@@ -195,7 +289,6 @@ class DeepdriveDatasetWriter(object):
             [], [], [], [], [], [], [], [], []
         if annotations_for_picture_id is None:
             return boxid, xmin, xmax, ymin, ymax, label_id, label, truncated, occluded
-        scene_attributes = annotations_for_picture_id['attributes']
         for obj in annotations_for_picture_id['labels']:
             if 'box2d' not in obj:
                 continue
@@ -211,11 +304,95 @@ class DeepdriveDatasetWriter(object):
             class_label_id = DEEPDRIVE_LABELS.index(obj['category']) + 1
             label_id.append(class_label_id)
 
-            truncated.append(scene_attributes.get('truncated', False))
-            occluded.append(scene_attributes.get('occluded', False))
+            attributes = obj.get('attributes', None) or dict()
+            truncated.append(attributes.get('truncated', False))
+            occluded.append(attributes.get('occluded', False))
         return boxid, xmin, xmax, ymin, ymax, label_id, label, truncated, occluded
 
-    def _get_tf_feature_dict(self, image_id, image_path, image_format, annotations, new_format=True):
+    @staticmethod
+    def _get_mask_label(category):
+        """
+        Maps the category of a poly2d annotation to an element of DEEPDRIVE_MASK_LABELS
+        :param category:
+        :return: the label or None, if the category is not written as mask
+        """
+        if category in DEEPDRIVE_MASK_LABELS:
+            return category
+        return DEEPDRIVE_MASK_LABEL_PREFIXES.get(category.split('/')[0], None)
+
+    def _get_polygons(self, annotations_for_picture_id, new_format=True):
+        """
+        Collects all poly2d annotations
+        :param annotations_for_picture_id:
+        :param new_format:
+        :return: maskid, label_id, label, polygons (for each mask a list of (vertices, closed))
+        """
+        maskid, label_id, label, polygons = [], [], [], []
+        if annotations_for_picture_id is None:
+            return maskid, label_id, label, polygons
+        if new_format:
+            objects = annotations_for_picture_id['labels']
+        else:
+            objects = [obj for frame in annotations_for_picture_id['frames'] for obj in frame['objects']]
+        for obj in objects:
+            if 'poly2d' not in obj or not obj['poly2d']:
+                continue
+            mask_label = DeepdriveDatasetWriter._get_mask_label(obj['category'])
+            if mask_label is None:
+                continue
+            if isinstance(obj['poly2d'][0], dict):
+                # new format: list of {'vertices': [[x, y], ...], 'types': 'LLC', 'closed': bool}
+                # bezier control points ('C') are used as plain vertices
+                obj_polygons = [(p['vertices'], p.get('closed', mask_label == 'drivable area'))
+                                for p in obj['poly2d']]
+            else:
+                # old format: list of [x, y, type]
+                obj_polygons = [([point[:2] for point in obj['poly2d']], mask_label == 'drivable area')]
+            maskid.append(obj['id'])
+            label.append(mask_label)
+            # as for the boxes, class_label_id = 0 --> background
+            label_id.append(DEEPDRIVE_MASK_LABELS.index(mask_label) + 1)
+            polygons.append(obj_polygons)
+        return maskid, label_id, label, polygons
+
+    def _get_mask_feature_dict(self, annotations, new_format, image_width, image_height):
+        """
+        Rasterizes the poly2d annotations and returns the run-length-encoded masks as features
+        :param annotations:
+        :param new_format:
+        :param image_width:
+        :param image_height:
+        :return:
+        """
+        maskid, label_id, label, polygons = self._get_polygons(annotations, new_format)
+        rle = []
+        for obj_polygons in polygons:
+            mask = np.zeros((image_height, image_width), dtype=bool)
+            for vertices, closed in obj_polygons:
+                if closed:
+                    mask |= rasterize_polygon(vertices, image_width, image_height)
+                else:
+                    mask |= rasterize_polyline(vertices, image_width, image_height)
+            rle.append(rle_encode(mask))
+
+        tmp_feat_dict = DeepdriveDatasetWriter.mask_feature_dict
+        tmp_feat_dict['image/object/mask/id'] = int64_feature(maskid)
+        tmp_feat_dict['image/object/mask/rle'] = bytes_feature(rle)
+        tmp_feat_dict['image/object/mask/class/label'] = int64_feature(label_id)
+        tmp_feat_dict['image/object/mask/class/label/name'] = bytes_feature(
+            [tf.compat.as_bytes(l) for l in label])
+        return tmp_feat_dict
+
+    def _get_tf_feature_dict(self, image_id, image_path, image_format, annotations, new_format=True,
+                             compact=False, normalize_boxes=False, write_masks=False):
+        if write_masks:
+            feat_dict = dict(self._get_tf_feature_dict(
+                image_id, image_path, image_format, annotations, new_format, compact, normalize_boxes))
+            im = Image.open(image_path)
+            image_width, image_height = im.size
+            feat_dict.update(self._get_mask_feature_dict(annotations, new_format, image_width, image_height))
+            return feat_dict
+
         if not new_format:
             boxid, xmin, xmax, ymin, ymax, label_id, label, truncated, occluded = \
                 self._get_boundingboxes(annotations)
@@ -233,6 +410,11 @@ class DeepdriveDatasetWriter(object):
         image_filename = os.path.basename(image_path)
         image_fileid = re.search('^(.*)(\.jpg)$', image_filename).group(1)
 
+        if compact:
+            return self._get_compact_tf_feature_dict(
+                image_fileid, image_path, image_filename, image_format, image_width, image_height,
+                boxid, xmin, xmax, ymin, ymax, label_id, truncated, occluded, normalize_boxes)
+
         tmp_feat_dict = DeepdriveDatasetWriter.feature_dict
         tmp_feat_dict['image/id'] = bytes_feature(image_fileid)
         tmp_feat_dict['image/source_id'] = bytes_feature(image_fileid)
@@ -255,6 +437,43 @@ class DeepdriveDatasetWriter(object):
 
         return tmp_feat_dict
 
+    def _get_compact_tf_feature_dict(self, image_fileid, image_path, image_filename, image_format,
+                                     image_width, image_height, boxid, xmin, xmax, ymin, ymax,
+                                     label_id, truncated, occluded, normalize_boxes=False):
+        """
+        Returns the feature dict of the compact schema. The boxes are stored as one little-endian float32 buffer
+        of shape [N, 4] in the order (ymin, xmin, ymax, xmax), the ids as int64 buffer, the labels as uint8 buffer
+        and the truncated / occluded flags bit-packed.
+        :param normalize_boxes: divide the box coordinates by the image width / height before storing them
+        :return:
+        """
+        boxes = np.asarray([ymin, xmin, ymax, xmax], dtype='<f4').reshape(4, len(boxid)).T
+        if normalize_boxes:
+            boxes = boxes / np.asarray([image_height, image_width, image_height, image_width], dtype='<f4')
+        boxes = np.ascontiguousarray(boxes, dtype='<f4')
+
+        tmp_feat_dict = DeepdriveDatasetWriter.compact_feature_dict
+        tmp_feat_dict['image/schema_version'] = int64_feature(DEEPDRIVE_SCHEMA_COMPACT)
+        tmp_feat_dict['image/id'] = bytes_feature(image_fileid)
+        tmp_feat_dict['image/source_id'] = bytes_feature(image_fileid)
+        tmp_feat_dict['image/height'] = int64_feature(image_height)
+        tmp_feat_dict['image/width'] = int64_feature(image_width)
+        with open(image_path, 'rb') as f:
+            tmp_feat_dict['image/encoded'] = bytes_feature(f.read())
+        tmp_feat_dict['image/format'] = bytes_feature(image_format)
+        tmp_feat_dict['image/filename'] = bytes_feature(image_filename)
+        tmp_feat_dict['image/object/count'] = int64_feature(len(boxid))
+        tmp_feat_dict['image/object/bbox/packed'] = bytes_feature(boxes.tobytes())
+        tmp_feat_dict['image/object/bbox/normalized'] = int64_feature(int(normalize_boxes))
+        tmp_feat_dict['image/object/bbox/id/packed'] = bytes_feature(np.asarray(boxid, dtype='<i8').tobytes())
+        tmp_feat_dict['image/object/bbox/truncated/packed'] = bytes_feature(
+            np.packbits(np.asarray(truncated, dtype=bool)).tobytes())
+        tmp_feat_dict['image/object/bbox/occluded/packed'] = bytes_feature(
+            np.packbits(np.asarray(occluded, dtype=bool)).tobytes())
+        tmp_feat_dict['image/object/class/label/packed'] = bytes_feature(
+            np.asarray(label_id, dtype=np.uint8).tobytes())
+        return tmp_feat_dict
+
     @staticmethod
     def get_annotation(picture_id, full_labels_path=None):
         """
@@ -270,6 +489,88 @@ class DeepdriveDatasetWriter(object):
                 full_labels_path, picture_id + '.json'), 'r') as f:
             return json.loads(f.read())
 
+    @staticmethod
+    def get_annotations_dict_from_folder(full_labels_path, picture_ids, num_threads=16, consolidated_path=None):
+        """
+        Loads the annotations of the old data-format (one json file per picture_id) up front. The files are read
+        with a pool of threads, so that the latency of opening many small files overlaps.
+        If consolidated_path is given, the annotations are read from this single json file and only the missing
+        picture_ids are loaded from the folder. Afterwards the consolidated file is (re-)written.
+        Returns a dict with the image-id as key with all the labels
+        :param full_labels_path:
+        :param picture_ids: list of picture_ids to load
+        :param num_threads: number of threads reading the json files (default: 16)
+        :param consolidated_path: path of the consolidated annotation file (default: None)
+        :return:
+        """
+        obj_annotation_dict = dict()
+        if consolidated_path is not None and os.path.exists(consolidated_path):
+            with open(consolidated_path, 'r') as f:
+                obj_annotation_dict = json.load(f)
+
+        missing_ids = [p for p in picture_ids if p not in obj_annotation_dict]
+        if missing_ids:
+            pool = ThreadPool(max(1, num_threads))
+            try:
+                annotations = pool.map(
+                    lambda p: DeepdriveDatasetWriter.get_annotation(p, full_labels_path), missing_ids)
+            finally:
+                pool.close()
+                pool.join()
+            obj_annotation_dict.update(zip(missing_ids, annotations))
+
+            if consolidated_path is not None:
+                with open(consolidated_path, 'w') as f:
+                    json.dump(obj_annotation_dict, f)
+        return obj_annotation_dict
+
+    def get_annotations_dict(self, fold_type, version, full_labels_path, new_format, picture_ids,
+                             annotation_threads=16, consolidate_annotations=False):
+        """
+        Loads the annotations of the fold for both data-formats (see get_image_label_folder)
+        Returns a dict with the image-id as key with all the labels
+        :param fold_type:
+        :param version:
+        :param full_labels_path:
+        :param new_format:
+        :param picture_ids: the picture_ids to load (only used for the old data-format)
+        :param annotation_threads: number of threads loading the json files of the old data-format
+        :param consolidate_annotations: use a consolidated annotation file for the old data-format
+        :return:
+        """
+        logger = logging.getLogger(__name__)
+        obj_annotation_dict = dict()
+        if not new_format:
+            # the annotations loaded for other folds / versions are reused, only the missing ones are loaded
+            obj_annotation_dict = self._annotation_cache.setdefault(full_labels_path, dict())
+            missing_ids = [p for p in picture_ids if p not in obj_annotation_dict]
+            if not missing_ids:
+                return obj_annotation_dict
+            consolidated_path = None
+            if consolidate_annotations:
+                consolidated_path = os.path.join(
+                    self.input_path, 'labels', 'consolidated_{0}_{1}.json'.format(
+                        version if version is not None else '100k', fold_type))
+            logger.info('Loading {0} annotation files with {1} threads'.format(
+                len(missing_ids), annotation_threads))
+            obj_annotation_dict.update(DeepdriveDatasetWriter.get_annotations_dict_from_folder(
+                full_labels_path, missing_ids, annotation_threads, consolidated_path))
+        elif fold_type != 'test':
+            label_file = os.path.join(
+                full_labels_path, 'bdd100k_labels_images_{0}.json'.format(
+                    fold_type))
+            if label_file in self._annotation_cache:
+                return self._annotation_cache[label_file]
+            try:
+                obj_annotation_dict = DeepdriveDatasetWriter.\
+                    get_annotations_dict_from_single_json(label_file)
+            except BaseException as e:
+                logger.error('Error loading the label json from: {0} '
+                             'Error: {1}'.format(label_file, str(e)))
+                exit(-1)
+            self._annotation_cache[label_file] = obj_annotation_dict
+        return obj_annotation_dict
+
     @staticmethod
     def get_annotations_dict_from_single_json(json_path):
         """
@@ -288,7 +589,8 @@ class DeepdriveDatasetWriter(object):
             obj_annotation_dict[tmp_filename] = element
         return obj_annotation_dict
 
-    def _get_tf_feature(self, image_id, image_path, image_format, annotations, new_format=True):
+    def _get_tf_feature(self, image_id, image_path, image_format, annotations, new_format=True,
+                        compact=False, normalize_boxes=False, write_masks=False):
         """
         Returns a tf.train.Features object for the given image_id
         :param image_id:
@@ -296,23 +598,31 @@ class DeepdriveDatasetWriter(object):
         :param image_format:
         :param annotations:
         :param new_format:
+        :param compact: write the compact schema (DEEPDRIVE_SCHEMA_COMPACT)
+        :param normalize_boxes: store normalized box coordinates (only used for the compact schema)
+        :param write_masks: add the run-length-encoded poly2d masks
         :return:
         """
         feature_dict = self._get_tf_feature_dict(
-            image_id, image_path, image_format, annotations, new_format)
+            image_id, image_path, image_format, annotations, new_format, compact, normalize_boxes,
+            write_masks)
         return tf.train.Features(feature=feature_dict)
 
     @staticmethod
     def get_output_file_name_template(output_path, fold_type, version, small_size=None,
-                                      weather_type=None, scene_type=None, daytime_type=None):
+                                      weather_type=None, scene_type=None, daytime_type=None,
+                                      compact=False):
         """
         Returns string with str template: iteration
         :param fold_type:
         :param version:
         :param small_size:
+        :param compact:
         :return:
         """
         extra_parts = ''
+        if compact:
+            extra_parts += 'compact_'
         if small_size is not None:
             extra_parts += 'number_of_files_{0}_'.format(small_size)
         if weather_type is not None:
@@ -329,75 +639,32 @@ class DeepdriveDatasetWriter(object):
             )
         )
 
-    def write_tfrecord(self, fold_type=None, version=None,
-                       max_elements_per_file=1000, write_masks=False,
-                       small_size=None, weather_type=None, scene_type=None,
-                       daytime_type=None):
+    def _get_write_elements(self, fold_type=None, version=None, small_size=None, weather_type=None,
+                            scene_type=None, daytime_type=None, annotation_threads=16,
+                            consolidate_annotations=False):
         """
-        Method which opens the tf.Session and actually writes the files
-        :param fold_type: 'train', 'val', 'test'
-        :param version: '100k', '10k'
-        :param max_elements_per_file: the number of elements per file,
-        after this number of elements a new tfrecord file is created
-        :param write_masks: unused flag
-        :param small_size: Parameter to limit the number of files which shall be written to files.
-        [E.g. to test overfitting] (default: None)
-        :return:
+        Collects the images which shall be written for the fold / version and applies the filters
+        :return: new_format, list of (picture_id, image_path, image_format, annotations)
         """
         logger = logging.getLogger(__name__)
-        assert (small_size is None or (isinstance(small_size, int) and small_size > 0))
-        output_path = os.path.join(self.input_path, 'tfrecord', version if version is not None else '100k', fold_type)
-        if not os.path.exists(output_path):
-            mkdir_p(output_path)
-
         full_images_path, full_labels_path, new_format = self.get_image_label_folder(fold_type, version)
 
-        obj_annotation_dict = dict()
-        if new_format and fold_type != 'test':
-            label_file = os.path.join(
-                full_labels_path, 'bdd100k_labels_images_{0}.json'.format(
-                    fold_type))
-            try:
-                obj_annotation_dict = DeepdriveDatasetWriter.\
-                    get_annotations_dict_from_single_json(label_file)
-            except BaseException as e:
-                logger.error('Error loading the label json from: {0} '
-                             'Error: {1}'.format(label_file, str(e)))
-                exit(-1)
-
         # get the files
-        image_files = DeepdriveDatasetDownload.filter_files(full_images_path, True)
-        if small_size is not None:
-            logger.info('Limiting the number of files written to TFrecord files to {0} files'.format(small_size))
-        if weather_type is not None:
-            logger.info('Limit to weather-type: {0}'.format(weather_type))
-        if scene_type is not None:
-            logger.info('Limit to scene-type: {0}'.format(scene_type))
-        if daytime_type is not None:
-            logger.info('Limit to daytime-type: {0}'.format(daytime_type))
-
+        image_files = self._filter_files(full_images_path)
         image_filename_regex = re.compile('^(.*)\.(jpg)$')
-        tfrecord_file_id, writer = 0, None
-        tfrecord_filename_template = DeepdriveDatasetWriter.get_output_file_name_template(
-            output_path, fold_type, version, small_size, weather_type,
-            scene_type, daytime_type
-        )
-        write_counter = 0
-        with tf.Session() as sess:
-            sess.run(tf.global_variables_initializer())
-            for file_counter, f in enumerate(image_files):
-                if write_counter % max_elements_per_file == 0:
-                    if writer is not None and write_counter != 0:
-                        writer.close()
-                        tfrecord_file_id += 1
-                    tmp_filename_tfrecord = tfrecord_filename_template.format(iteration=tfrecord_file_id)
-                    logger.info('{0}: Create TFRecord filename: {1} after processing {2}/{3} files'.format(
-                        str(datetime.datetime.now()), tmp_filename_tfrecord, file_counter, len(image_files)
-                    ))
-                    writer = tf.python_io.TFRecordWriter(tmp_filename_tfrecord)
-                elif write_counter % 250 == 0:
-                    logger.info('\t{0}: Processed file: {1}/{2}'.format(
-                        str(datetime.datetime.now()), file_counter, len(image_files)))
+
+        # with small_size the annotations are loaded in chunks, so that only a few more annotations than needed
+        # are loaded (the old data-format has one json file per image)
+        chunk_size = len(image_files) if small_size is None else max(2 * small_size, annotation_threads)
+        elements = []
+        for chunk_start in range(0, len(image_files), max(1, chunk_size)):
+            chunk_files = image_files[chunk_start:chunk_start + chunk_size]
+            picture_ids = [m.group(1) for m in map(image_filename_regex.search, chunk_files) if m is not None]
+            obj_annotation_dict = self.get_annotations_dict(
+                fold_type, version, full_labels_path, new_format, picture_ids,
+                annotation_threads, consolidate_annotations)
+
+            for f in chunk_files:
                 # match the filename with the regex
                 m = image_filename_regex.search(f)
                 if m is None:
@@ -407,11 +674,7 @@ class DeepdriveDatasetWriter(object):
 
                 picture_id = m.group(1)
                 # get the annotations for the given file
-                if not new_format:
-                    picture_id_annotations = DeepdriveDatasetWriter.get_annotation(
-                        picture_id, full_labels_path=full_labels_path)
-                else:
-                    picture_id_annotations = obj_annotation_dict.get(picture_id, None)
+                picture_id_annotations = obj_annotation_dict.get(picture_id, None)
 
                 if picture_id_annotations is None:
                     continue
@@ -429,17 +692,135 @@ class DeepdriveDatasetWriter(object):
                         attributes['timeofday'] != daytime_type:
                     continue
 
+                elements.append((picture_id, os.path.join(full_images_path, f), m.group(2), picture_id_annotations))
+
+                # we leave it if enough files were collected
+                if small_size is not None and len(elements) >= small_size:
+                    return new_format, elements
+        return new_format, elements
+
+    def _write_tfrecord_file(self, filename, elements, new_format=True, compact=False, normalize_boxes=False,
+                             write_masks=False):
+        """
+        Writes the elements to one tfrecord file
+        :param filename:
+        :param elements: list of (picture_id, image_path, image_format, annotations)
+        :return: the number of written elements
+        """
+        logger = logging.getLogger(__name__)
+        logger.info('{0}: Create TFRecord filename: {1} with {2} files'.format(
+            str(datetime.datetime.now()), filename, len(elements)))
+        writer = tf.python_io.TFRecordWriter(filename)
+        try:
+            for picture_id, image_path, image_format, annotations in elements:
                 feature = self._get_tf_feature(
-                    picture_id, os.path.join(full_images_path, f),
-                    m.group(2), picture_id_annotations, new_format)
+                    picture_id, image_path, image_format, annotations, new_format,
+                    compact, normalize_boxes, write_masks)
                 example = tf.train.Example(features=feature)
                 writer.write(example.SerializeToString())
-                write_counter += 1
+        finally:
+            writer.close()
+        return len(elements)
+
+    def _get_write_jobs(self, fold_type=None, version=None,
+                        max_elements_per_file=1000, write_masks=False,
+                        small_size=None, weather_type=None, scene_type=None,
+                        daytime_type=None, compact=False, normalize_boxes=False,
+                        annotation_threads=16, consolidate_annotations=False):
+        """
+        Splits the conversion of one fold / version into jobs, one per tfrecord file
+        :return: list of arguments for _write_tfrecord_file
+        """
+        logger = logging.getLogger(__name__)
+        assert (small_size is None or (isinstance(small_size, int) and small_size > 0))
+        output_path = os.path.join(self.input_path, 'tfrecord', version if version is not None else '100k', fold_type)
+        if not os.path.exists(output_path):
+            mkdir_p(output_path)
 
-                # we leave it if enough files were written
-                if small_size is not None and write_counter >= small_size:
-                    break
+        logger.info('Preparing fold: {0} version: {1}'.format(fold_type, version))
+        if small_size is not None:
+            logger.info('Limiting the number of files written to TFrecord files to {0} files'.format(small_size))
+        if weather_type is not None:
+            logger.info('Limit to weather-type: {0}'.format(weather_type))
+        if scene_type is not None:
+            logger.info('Limit to scene-type: {0}'.format(scene_type))
+        if daytime_type is not None:
+            logger.info('Limit to daytime-type: {0}'.format(daytime_type))
+        if compact:
+            logger.info('Writing the compact schema (normalized boxes: {0})'.format(normalize_boxes))
+        if write_masks:
+            logger.info('Writing the poly2d annotations as masks')
 
-            # Close the last files
-            if writer is not None:
-                writer.close()
+        new_format, elements = self._get_write_elements(
+            fold_type, version, small_size, weather_type, scene_type, daytime_type,
+            annotation_threads, consolidate_annotations)
+
+        tfrecord_filename_template = DeepdriveDatasetWriter.get_output_file_name_template(
+            output_path, fold_type, version, small_size, weather_type,
+            scene_type, daytime_type, compact
+        )
+        return [
+            (tfrecord_filename_template.format(iteration=tfrecord_file_id),
+             elements[start:start + max_elements_per_file], new_format, compact, normalize_boxes, write_masks)
+            for tfrecord_file_id, start in enumerate(range(0, len(elements), max_elements_per_file))
+        ]
+
+    def write_tfrecord(self, fold_type=None, version=None,
+                       max_elements_per_file=1000, write_masks=False,
+                       small_size=None, weather_type=None, scene_type=None,
+                       daytime_type=None, compact=False, normalize_boxes=False,
+                       annotation_threads=16, consolidate_annotations=False):
+        """
+        Method which actually writes the files
+        :param fold_type: 'train', 'val', 'test'
+        :param version: '100k', '10k'
+        :param max_elements_per_file: the number of elements per file,
+        after this number of elements a new tfrecord file is created
+        :param write_masks: rasterize the poly2d annotations (drivable area, lanes) and store them as
+        run-length-encoded masks (default: False)
+        :param small_size: Parameter to limit the number of files which shall be written to files.
+        [E.g. to test overfitting] (default: None)
+        :param compact: write the compact schema with packed boxes, labels and flags (default: False)
+        :param normalize_boxes: store the boxes normalized by the image width/height. Only used together with
+        compact (default: False)
+        :param annotation_threads: number of threads loading the json files of the old data-format (default: 16)
+        :param consolidate_annotations: store the annotations of the old data-format in one json file, which is
+        read instead of the single files in later runs (default: False)
+        :return:
+        """
+        jobs = self._get_write_jobs(
+            fold_type, version, max_elements_per_file, write_masks, small_size, weather_type,
+            scene_type, daytime_type, compact, normalize_boxes, annotation_threads, consolidate_annotations)
+        for job in jobs:
+            self._write_tfrecord_file(*job)
+
+    def write_tfrecords(self, fold_types, versions, workers=None, **kwargs):
+        """
+        Writes several folds and versions. The folds are prepared one after another in this process (folder check,
+        directory scan, loading and filtering the annotations), the directory scans and the annotations are loaded
+        once and shared between all folds / versions. Only the tfrecord files are written concurrently, by one pool
+        of worker processes.
+        :param fold_types: list of fold types ('train', 'val', 'test')
+        :param versions: list of versions ('100k', '10k')
+        :param workers: number of worker processes (default: number of cpus)
+        :param kwargs: see write_tfrecord
+        :return:
+        """
+        logger = logging.getLogger(__name__)
+        # repeated folds / versions would let several workers write the same files
+        fold_types = [f for i, f in enumerate(fold_types) if f not in fold_types[:i]]
+        versions = [v for i, v in enumerate(versions) if v not in versions[:i]]
+        jobs = []
+        for version in versions:
+            for fold_type in fold_types:
+                jobs.extend(self._get_write_jobs(fold_type, version, **kwargs))
+        logger.info('Writing {0} tfrecord files for folds: {1} versions: {2}'.format(
+            len(jobs), fold_types, versions))
+
+        written = sum(map_largest_first(_write_tfrecord_file, jobs, lambda job: len(job[1]), workers))
+        logger.info('{0}: Wrote {1} files to {2} tfrecord files'.format(
+            str(datetime.datetime.now()), written, len(jobs)))
+
+
+def _write_tfrecord_file(*args):
+    return DeepdriveDatasetWriter()._write_tfrecord_file(*args)
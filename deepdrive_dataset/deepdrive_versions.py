@@ -1,3 +1,13 @@
 DEEPDRIVE_FOLDS = ['train', 'val', 'test']
 DEEPDRIVE_VERSIONS = ['100k', '10k']
-DEEPDRIVE_LABELS = ['bus', 'traffic light', 'traffic sign', 'person', 'bike', 'truck', 'motor', 'car', 'train', 'rider']
\ No newline at end of file
+DEEPDRIVE_LABELS = ['bus', 'traffic light', 'traffic sign', 'person', 'bike', 'truck', 'motor', 'car', 'train', 'rider']
+# Categories of the poly2d annotations, which are written as masks. Old-format categories like 'area/drivable' or
+# 'lane/single white' are mapped by their prefix.
+DEEPDRIVE_MASK_LABELS = ['drivable area', 'lane']
+DEEPDRIVE_MASK_LABEL_PREFIXES = {'area': 'drivable area', 'lane': 'lane'}
+
+# Versions of the tf.train.Example layout written by the DeepdriveDatasetWriter.
+# The legacy schema stores one repeated feature per box coordinate, the compact schema packs the boxes,
+# labels and flags into raw byte strings.
+DEEPDRIVE_SCHEMA_LEGACY = 1
+DEEPDRIVE_SCHEMA_COMPACT = 2
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def rasterize_polygon(vertices, width, height):
+    """
+    Rasterizes a closed polygon into a boolean mask (even-odd rule). A pixel is set if its center lies inside the
+    polygon. The intersections of all edges with all pixel rows are computed at once and the spans between pairs
+    of intersections are filled using a cumulative sum, so there is no loop over pixels or rows.
+    :param vertices: array-like [(x, y), ...]
+    :param width:
+    :param height:
+    :return: np.ndarray of shape [height, width] and dtype bool
+    """
+    mask = np.zeros((height, width), dtype=bool)
+    v = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    if v.shape[0] < 3:
+        return mask
+    x0, y0 = v[:, 0], v[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # rows x edges: the x-coordinate at which each edge crosses the center of each row
+    row_centers = (np.arange(height, dtype=np.float64) + 0.5)[:, None]
+    crosses = (y0 <= row_centers) != (y1 <= row_centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = x0 + (row_centers - y0) * (x1 - x0) / (y1 - y0)
+    xs = np.where(crosses, xs, np.inf)
+    xs.sort(axis=1)
+    if xs.shape[1] % 2 == 1:
+        xs = np.concatenate([xs, np.full((height, 1), np.inf)], axis=1)
+
+    starts, ends = xs[:, 0::2], xs[:, 1::2]
+    rows, cols = np.nonzero(np.isfinite(ends))
+    if rows.size == 0:
+        return mask
+    # the pixel c is filled if its center c + 0.5 lies within [start, end)
+    start_px = np.clip(np.ceil(starts[rows, cols] - 0.5), 0, width).astype(np.int64)
+    end_px = np.clip(np.ceil(ends[rows, cols] - 0.5), 0, width).astype(np.int64)
+
+    deltas = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(deltas, (rows, start_px), 1)
+    np.add.at(deltas, (rows, end_px), -1)
+    return np.cumsum(deltas, axis=1)[:, :width] > 0
+
+
+def rasterize_polyline(vertices, width, height):
+    """
+    Rasterizes an open polyline (e.g. a lane marking) with a width of one pixel. Every segment is sampled with
+    one point per pixel of its length, all segments at once.
+    :param vertices: array-like [(x, y), ...]
+    :param width:
+    :param height:
+    :return: np.ndarray of shape [height, width] and dtype bool
+    """
+    mask = np.zeros((height, width), dtype=bool)
+    v = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    if v.shape[0] == 0:
+        return mask
+    if v.shape[0] == 1:
+        points = v
+    else:
+        start, delta = v[:-1], np.diff(v, axis=0)
+        num_samples = np.ceil(np.abs(delta).max(axis=1)).astype(np.int64) + 1
+        segment = np.repeat(np.arange(start.shape[0]), num_samples)
+        # position of each sample within its segment in [0, 1]
+        offsets = np.arange(segment.size) - np.repeat(np.cumsum(num_samples) - num_samples, num_samples)
+        t = offsets / np.maximum(num_samples[segment] - 1, 1).astype(np.float64)
+        points = start[segment] + t[:, None] * delta[segment]
+    px = np.floor(points).astype(np.int64)
+    valid = (px[:, 0] >= 0) & (px[:, 0] < width) & (px[:, 1] >= 0) & (px[:, 1] < height)
+    mask[px[valid, 1], px[valid, 0]] = True
+    return mask
+
+
+def rle_encode(mask):
+    """
+    Run-length encodes a mask in row-major order. The runs alternate between background and foreground and
+    always start with a (possibly empty) background run.
+    :param mask: np.ndarray of shape [height, width]
+    :return: bytes - little-endian int32 run lengths
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+    if flat.size == 0:
+        return b''
+    boundaries = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]])
+    counts = np.diff(boundaries)
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.astype('<i4').tobytes()
+
+
+def rle_decode(rle, width, height):
+    """
+    Decodes a mask encoded with rle_encode
+    :param rle: bytes
+    :param width:
+    :param height:
+    :return: np.ndarray of shape [height, width] and dtype bool
+    """
+    counts = np.frombuffer(rle, dtype='<i4')
+    values = np.arange(counts.size) % 2 == 1
+    return np.repeat(values, counts).reshape(height, width)
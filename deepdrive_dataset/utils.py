@@ -1,6 +1,7 @@
 import errno
 import os
 import sys
+from multiprocessing import Pool
 
 
 def mkdir_p(path):
@@ -10,4 +11,28 @@ def mkdir_p(path):
         if exc.errno == errno.EEXIST and os.path.isdir(path):
             pass
         else:
-            raise
\ No newline at end of file
+            raise
+
+
+def _call_star(args):
+    function, function_args = args
+    return function(*function_args)
+
+
+def map_largest_first(function, jobs, size, processes=None):
+    """
+    Calls the function for every job in a pool of worker processes. The largest jobs are started first, so that
+    the last worker does not keep the pool waiting.
+    :param function: module level function (it is pickled and sent to the workers)
+    :param jobs: list of argument tuples
+    :param size: returns the size of a job
+    :param processes: number of worker processes (default: number of cpus)
+    :return: list of results, in the order in which the jobs finished
+    """
+    pool = Pool(processes)
+    try:
+        return list(pool.imap_unordered(
+            _call_star, [(function, job) for job in sorted(jobs, key=size, reverse=True)], chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
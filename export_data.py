@@ -0,0 +1,36 @@
+import argparse
+import logging
+
+from deepdrive_dataset.deepdrive_dataset_export import DeepdriveDatasetExport
+from deepdrive_dataset.deepdrive_versions import DEEPDRIVE_FOLDS, DEEPDRIVE_VERSIONS
+
+if __name__ == '__main__':
+    logging.getLogger(__name__).setLevel(logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fold_type', type=str, choices=DEEPDRIVE_FOLDS, default='train')
+    parser.add_argument('--version', type=str, default='100k', choices=DEEPDRIVE_VERSIONS)
+    parser.add_argument('--format', type=str, default='arrow', choices=['arrow', 'parquet'],
+                        help='arrow: memory-mappable arrow file, parquet: compressed parquet file')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output file (default: ~/.deepdrive/columnar/[version]/[fold_type].[format])')
+    parser.add_argument('--annotation_threads', type=int, default=16,
+                        help='Number of threads loading the annotation files of the old data format')
+    parser.add_argument('--compact', action='store_true',
+                        help='Export the files written with --compact')
+    parser.add_argument('--number_images_to_write', type=int, default=None,
+                        help='Export the files written with this --number_images_to_write')
+    parser.add_argument('--weather', type=str, default=None,
+                        help='Export the files written with this --weather')
+    parser.add_argument('--scene_type', type=str, default=None,
+                        help='Export the files written with this --scene_type')
+    parser.add_argument('--daytime', type=str, default=None,
+                        help='Export the files written with this --daytime')
+    FLAGS = parser.parse_args()
+
+    exporter = DeepdriveDatasetExport()
+    output_path = exporter.export(
+        FLAGS.fold_type, FLAGS.version, output_format=FLAGS.format,
+        output_path=FLAGS.output, annotation_threads=FLAGS.annotation_threads,
+        small_size=FLAGS.number_images_to_write, weather_type=FLAGS.weather,
+        scene_type=FLAGS.scene_type, daytime_type=FLAGS.daytime, compact=FLAGS.compact)
+    print('Exported annotations to: {0}'.format(output_path))
@@ -1,19 +1,111 @@
 import argparse
+import itertools
+import json
+import time
 
 import matplotlib.pyplot as plt
+import numpy as np
 import tensorflow as tf
 from matplotlib.patches import Rectangle
 
 from deepdrive_dataset.deepdrive_dataset_reader import DeepdriveDatasetReader
 from deepdrive_dataset.deepdrive_versions import DEEPDRIVE_FOLDS, DEEPDRIVE_VERSIONS
 
+BENCHMARK_PARAMETERS = ['batch_size', 'threads', 'parallel_reads', 'buffer_size']
+
+
+def benchmark(fold_type, version, batch_size, threads, parallel_reads, buffer_size,
+              warmup_batches=10, timed_batches=100):
+    """
+    Measures the throughput of the DeepdriveDatasetReader input pipeline.
+    :param warmup_batches: number of batches which are fetched before the timing starts
+    :param timed_batches: number of batches which are timed
+    :return: dict with the parameters, images/s, batches/s, latency percentiles (ms) and the time to the first batch
+    """
+    with tf.Graph().as_default():
+        reader = DeepdriveDatasetReader(
+            batch_size=batch_size, epochs=None, threads=threads,
+            parallel_reads=parallel_reads, buffer_size=buffer_size)
+        iterator = reader.load_data_bbox(fold_type, version, False)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            start = time.time()
+            sess.run(iterator)
+            time_to_first_batch = time.time() - start
+            for _ in range(max(0, warmup_batches - 1)):
+                sess.run(iterator)
+
+            latencies, images = [], 0
+            start = time.time()
+            for _ in range(timed_batches):
+                batch_start = time.time()
+                out = sess.run(iterator)
+                latencies.append(time.time() - batch_start)
+                images += out[0].shape[0]
+            duration = time.time() - start
+
+    latencies = np.asarray(latencies) * 1000.
+    return dict(
+        batch_size=batch_size, threads=threads, parallel_reads=parallel_reads, buffer_size=buffer_size,
+        images_per_second=images / duration, batches_per_second=timed_batches / duration,
+        latency_ms_p50=float(np.percentile(latencies, 50)),
+        latency_ms_p90=float(np.percentile(latencies, 90)),
+        latency_ms_p99=float(np.percentile(latencies, 99)),
+        time_to_first_batch_s=time_to_first_batch,
+    )
+
+
+def parse_sweep(sweep):
+    """
+    Parses the sweep arguments ['threads=2,4,8', 'buffer_size=64,256'] to a dict {'threads': [2, 4, 8], ...}
+    :param sweep:
+    :return:
+    """
+    sweep_dict = dict()
+    for element in sweep:
+        key, _, values = element.partition('=')
+        if key not in BENCHMARK_PARAMETERS or not values:
+            raise BaseException('Invalid sweep argument: {0}. Expected one of {1} with values '
+                                '(e.g. threads=2,4,8)'.format(element, BENCHMARK_PARAMETERS))
+        sweep_dict[key] = [int(v) for v in values.split(',')]
+    return sweep_dict
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--batch_size', type=int, help='Batch Size to use', default=4)
     parser.add_argument('--fold_type', type=str, choices=DEEPDRIVE_FOLDS, default='train')
     parser.add_argument('--version', type=str, default='100k', choices=DEEPDRIVE_VERSIONS)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Measure the throughput of the input pipeline instead of plotting a batch')
+    parser.add_argument('--threads', type=int, default=4, help='Parallel calls to the parsing function')
+    parser.add_argument('--parallel_reads', type=int, default=2, help='Number of tfrecord files read in parallel')
+    parser.add_argument('--buffer_size', type=int, default=128, help='Buffer size used for the shuffling')
+    parser.add_argument('--warmup_batches', type=int, default=10, help='Batches fetched before timing')
+    parser.add_argument('--timed_batches', type=int, default=100, help='Batches which are timed')
+    parser.add_argument('--sweep', type=str, nargs='*', default=[],
+                        help='Benchmark all combinations of the given values, e.g. threads=2,4,8 buffer_size=64,256')
+    parser.add_argument('--output', type=str, default=None, help='Write the benchmark results as json to this file')
     FLAGS = parser.parse_args()
 
+    if FLAGS.benchmark:
+        sweep = parse_sweep(FLAGS.sweep)
+        values = [sweep.get(p, [getattr(FLAGS, p)]) for p in BENCHMARK_PARAMETERS]
+        results = []
+        for combination in itertools.product(*values):
+            result = benchmark(FLAGS.fold_type, FLAGS.version,
+                               warmup_batches=FLAGS.warmup_batches, timed_batches=FLAGS.timed_batches,
+                               **dict(zip(BENCHMARK_PARAMETERS, combination)))
+            print('batch_size={batch_size} threads={threads} parallel_reads={parallel_reads} '
+                  'buffer_size={buffer_size}: {images_per_second:.1f} images/s, {batches_per_second:.2f} batches/s, '
+                  'latency p50/p90/p99 {latency_ms_p50:.1f}/{latency_ms_p90:.1f}/{latency_ms_p99:.1f} ms, '
+                  'first batch {time_to_first_batch_s:.2f} s'.format(**result))
+            results.append(result)
+        if FLAGS.output is not None:
+            with open(FLAGS.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        exit(0)
+
     reader = DeepdriveDatasetReader(batch_size=FLAGS.batch_size)
     if FLAGS.fold_type == 'train':
         iterator = reader.load_train_data_bbox(FLAGS.version, False)
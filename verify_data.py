@@ -0,0 +1,33 @@
+import argparse
+import json
+import sys
+
+from deepdrive_dataset.deepdrive_dataset_verify import DeepdriveDatasetVerify
+from deepdrive_dataset.deepdrive_versions import DEEPDRIVE_FOLDS, DEEPDRIVE_VERSIONS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fold_type', type=str, choices=DEEPDRIVE_FOLDS, default='train')
+    parser.add_argument('--version', type=str, default='100k', choices=DEEPDRIVE_VERSIONS)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes (default: number of cpus)')
+    parser.add_argument('--sample_rate', type=float, default=0.0,
+                        help='Fraction of the records which are parsed and whose jpeg is decoded')
+    parser.add_argument('--no_box_check', action='store_true',
+                        help='Do not check the boxes of the sampled records against the image size')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the json report to this file instead of stdout')
+    FLAGS = parser.parse_args()
+
+    verifier = DeepdriveDatasetVerify(
+        processes=FLAGS.processes, sample_rate=FLAGS.sample_rate,
+        check_boxes=not FLAGS.no_box_check)
+    report = verifier.verify(FLAGS.fold_type, FLAGS.version)
+
+    if FLAGS.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(FLAGS.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if report['ok'] else 1)